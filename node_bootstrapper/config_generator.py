@@ -1,3 +1,5 @@
+import functools
+import os
 from configparser import ConfigParser
 from ipaddress import IPv4Address, IPv4Network
 from pathlib import Path
@@ -10,6 +12,7 @@ from rich.prompt import Confirm, Prompt
 from typing_extensions import Annotated
 
 from node_bootstrapper.utils import (
+    console,
     get_panel,
     refresh_device_state,
     run_command,
@@ -17,8 +20,6 @@ from node_bootstrapper.utils import (
     warning_style,
 )
 
-console = rich.console.Console()
-
 THIS_PATH = Path(__file__).resolve().parent
 
 TEMPLATE_PATH = THIS_PATH / Path("./templates/")
@@ -33,6 +34,27 @@ CONFIGURATION_FILE = THIS_PATH / Path("../config.ini")
 app = typer.Typer(no_args_is_help=True)
 
 
+@functools.lru_cache(maxsize=1)
+def _load_config(path: Path, mtime_ns: int) -> ConfigParser:
+    """
+    Parses the configuration file. Cached on the file's modification time. Values are
+    still interpolated when they're looked up, so a bad value only matters if it's
+    actually used.
+    """
+    config = ConfigParser()
+    config.read(path)
+    return config
+
+
+def load_config(path: Path = CONFIGURATION_FILE) -> ConfigParser:
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        console.print(f"Configuration file not found: {path}")
+        raise typer.Abort()
+    return _load_config(path, mtime_ns)
+
+
 def get_from_config(
     config: ConfigParser, key: str, section: str = "config_generator"
 ) -> str:
@@ -78,8 +100,7 @@ def cloud_init_config(
     ),
 ):
 
-    config = ConfigParser()
-    config.read(CONFIGURATION_FILE)
+    config = load_config()
 
     def _get_from_config(key: str) -> str:
         return get_from_config(config, key)
@@ -90,72 +111,83 @@ def cloud_init_config(
 
     if setup_eth:
         eth_network = IPv4Network(_get_from_config("eth_network"))
+        eth_addresses = [
+            str(eth_network[idx]) for idx in range(offset, hosts_number + offset)
+        ]
     if setup_wifi:
         wifi_network = IPv4Network(_get_from_config("wifi_network"))
+        wifi_addresses = [
+            str(wifi_network[idx]) for idx in range(offset, hosts_number + offset)
+        ]
+        wifi_ssid = _get_from_config("wifi_ssid")
+        wifi_password = _get_from_config("wifi_password")
 
+    # Templates don't change while we're running, so skip the mtime checks.
     jinja_environment = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(CLOUD_INIT_TEMPLATE_PATH)
+        loader=jinja2.FileSystemLoader(CLOUD_INIT_TEMPLATE_PATH),
+        auto_reload=False,
+        cache_size=-1,
+    )
+    user_data_template = jinja_environment.get_template("user-data.j2")
+    network_config_template = jinja_environment.get_template("network-config.j2")
+
+    # These don't change between hosts, so only look them up once.
+    hostname_string = _get_from_config("hostname_string")
+    remote_admin_acc_ssh_key = _get_from_config("remote_admin_acc_ssh_key")
+    remote_admin_acc_username = _get_from_config("remote_admin_acc_username")
+    local_admin_acc_username = _get_from_config("local_admin_acc_username")
+    # The salt is fixed, so the hash is the same for every host.
+    password_hash = sha512_crypt.using(rounds=5000, salt="s4ltsltsALLT").hash(
+        _get_from_config("local_admin_acc_password")
     )
 
     for host_idx in range(1 + offset, hosts_number + 1 + offset):
-        hostname = _get_from_config("hostname_string").format(
-            num=str(host_idx).zfill(2)
-        )
+        hostname = hostname_string.format(num=str(host_idx).zfill(2))
         console.print(f"Working on host: {hostname}", style="green bold")
 
         host_dir = CLOUD_INIT_OUTPUT_PATH / hostname
         host_dir.mkdir(exist_ok=True if force else False, parents=True)
-        password_hash = sha512_crypt.using(rounds=5000, salt="s4ltsltsALLT").hash(
-            _get_from_config("local_admin_acc_password")
-        )
 
-        user_data_template = jinja_environment.get_template("user-data.j2")
         user_data_content = user_data_template.render(
             hostname=hostname,
-            remote_admin_acc_ssh_key=_get_from_config("remote_admin_acc_ssh_key"),
-            remote_admin_acc_username=_get_from_config("remote_admin_acc_username"),
-            local_admin_acc_username=_get_from_config("local_admin_acc_username"),
+            remote_admin_acc_ssh_key=remote_admin_acc_ssh_key,
+            remote_admin_acc_username=remote_admin_acc_username,
+            local_admin_acc_username=local_admin_acc_username,
             local_admin_acc_password=password_hash,
         )
 
         user_data_file_path = host_dir / "user-data"
-        with open(user_data_file_path, "w") as user_data_file:
-            user_data_file.write(user_data_content)
-            if debug:
-                console.print(
-                    get_panel(
-                        text=user_data_content, title="user-data", border_style="white"
-                    )
+        user_data_file_path.write_bytes(user_data_content.encode("utf-8"))
+        if debug:
+            console.print(
+                get_panel(
+                    text=user_data_content, title="user-data", border_style="white"
                 )
-
-        network_config_template = jinja_environment.get_template("network-config.j2")
+            )
 
         render_args = {
             "gateway": gateway,
         }
         if setup_wifi:
-            wifi_address = wifi_network[host_idx - 1]
             render_args["setup_wifi"] = True
-            render_args["wifi_address"] = str(wifi_address)
-            render_args["wifi_ssid"] = _get_from_config("wifi_ssid")
-            render_args["wifi_password"] = _get_from_config("wifi_password")
+            render_args["wifi_address"] = wifi_addresses[host_idx - 1 - offset]
+            render_args["wifi_ssid"] = wifi_ssid
+            render_args["wifi_password"] = wifi_password
         if setup_eth:
-            eth_address = eth_network[host_idx - 1]
             render_args["setup_eth"] = True
-            render_args["eth_address"] = str(eth_address)
+            render_args["eth_address"] = eth_addresses[host_idx - 1 - offset]
         network_config_content = network_config_template.render(**render_args)
 
         network_config_file_path = host_dir / "network-config"
-        with open(network_config_file_path, "w") as network_config_file:
-            network_config_file.write(network_config_content)
-            if debug:
-                console.print(
-                    get_panel(
-                        text=network_config_content,
-                        title="network-config",
-                        border_style="white",
-                    )
+        network_config_file_path.write_bytes(network_config_content.encode("utf-8"))
+        if debug:
+            console.print(
+                get_panel(
+                    text=network_config_content,
+                    title="network-config",
+                    border_style="white",
                 )
+            )
 
         console.print(
             "Finished generating cloud-init configuration.", style=success_style
@@ -172,7 +204,7 @@ def cloud_init_config(
             ):
                 pass
 
-            output = run_command(f"lsblk {device}", debug=debug)
+            output = run_command(["lsblk", device], debug=debug, capture_stdout=True)
             console.print(
                 rich.panel.Panel(
                     output.stdout, title="Available Devices", box=rich.box.ROUNDED
@@ -181,27 +213,32 @@ def cloud_init_config(
             partition_to_use = Prompt.ask("Enter the partition to use")
             refresh_device_state(partition_to_use, debug=debug)
             # Mount the new partition
-            run_command("mkdir -p /mnt/data", debug)
+            run_command(["mkdir", "-p", "/mnt/data"], debug)
             # run_command(f"echo 'UUID={uuid} /mnt/data ext4 defaults 0 2' | tee -a /etc/fstab", debug)
-            run_command(f"mount {partition_to_use} /mnt/data", debug)
+            run_command(["mount", partition_to_use, "/mnt/data"], debug)
 
-            console.print("Copying user-data to /boot", style=success_style)
-            run_command(f"cp {user_data_file_path} /mnt/data", debug)
-            console.print("Copying network-config to /boot", style=success_style)
-            run_command(f"cp {network_config_file_path} /mnt/data", debug)
-            console.print("Copying cmdline.txt (enables cgroups).")
-            run_command(
-                f"cp {TEMPLATE_PATH / "cmdline.txt"} /mnt/data/cmdline.txt", debug
+            # Copy everything with a single `cp`, rather than one process per file.
+            console.print(
+                "Copying user-data, network-config, cmdline.txt (enables cgroups) "
+                "and config.txt to /boot",
+                style=success_style,
             )
-            console.print("Copying config.txt.")
             run_command(
-                f"cp {TEMPLATE_PATH / "config.txt"} /mnt/data/config.txt", debug
+                [
+                    "cp",
+                    str(user_data_file_path),
+                    str(network_config_file_path),
+                    str(TEMPLATE_PATH / "cmdline.txt"),
+                    str(TEMPLATE_PATH / "config.txt"),
+                    "/mnt/data/",
+                ],
+                debug,
             )
 
             console.print(
                 f"Unmounting partition {partition_to_use}", style=success_style
             )
-            run_command("umount /mnt/data", debug)
+            run_command(["umount", "/mnt/data"], debug)
             console.print(
                 "Finished copying cloud-init configuration.", style=success_style
             )
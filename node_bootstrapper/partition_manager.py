@@ -1,5 +1,12 @@
+import errno
+import mmap
 import os
+import queue
+import re
+import stat
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import rich
@@ -8,35 +15,36 @@ from rich.progress import Progress
 from rich.prompt import Confirm, IntPrompt, Prompt
 
 from node_bootstrapper.utils import (
+    clear_device_state_caches,
+    console,
+    device_is_empty,
     error_style,
+    partition_path,
+    read_sysfs_partitions,
     refresh_device_state,
     run_command,
     success_style,
+    wait_for_device,
     warning_style,
 )
 
 app = typer.Typer(no_args_is_help=True)
-console = rich.console.Console()
 
 MIN_SYSTEM_SIZE = 20  # Minimum recommended system partition size in GB
+PARTITION_ALIGNMENT = 1024 * 1024  # Partitions start and end on multiples of this
 
-
-def check_device_empty(device: str, debug: bool = False) -> bool:
-    """
-    Checks if the given device is empty. Returns True if the device is empty,
-    otherwise returns False.
-    """
-    refresh_device_state(device, debug)
-    result = run_command(f"lsblk {device}", debug)
-    return len(result.stdout.splitlines()) <= 2
+# The number of bytes copied in a `dd status=progress` line, e.g. `4194304 bytes (4.2 MB, ...`
+DD_PROGRESS_RE = re.compile(rb"(\d+)\s+bytes")
+# An error message of dd, e.g. `dd: failed to open '/dev/sdz': No such file or directory`
+DD_ERROR_RE = re.compile(rb"(?:^|\r)(dd: [^\r\n]*)", re.MULTILINE)
 
 
-def get_disk_capacity(device: str, debug: bool = False) -> int:
+def get_disk_capacity(device: str) -> int:
     """
     Gets the capacity of the specified disk in GB.
     """
-    result = run_command(f"lsblk -b -d -o SIZE -n {device}", debug)
-    size_bytes = int(result.stdout.strip())
+    sector_size, total_sectors, _ = read_sysfs_partitions(device)
+    size_bytes = total_sectors * sector_size
     size_gb = size_bytes / (1024**3)
     return size_gb
 
@@ -52,75 +60,269 @@ def erase_device(device: str, debug: bool):
         ),
     ):
         console.print(f"Erasing all partitions on {device}.", style=warning_style)
-        run_command(f"parted {device} --script mklabel msdos", debug)
+        run_command(["parted", device, "--script", "mklabel", "msdos"], debug)
         refresh_device_state(device, debug)
     else:
         console.print("Operation cancelled.", style=error_style)
         raise typer.Abort()
 
 
-def copy_image_with_progress(image_path: str, device: str, debug: bool):
+KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Bytes copied by a single in-kernel copy
+IO_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes read/written by a single direct I/O request
+IO_QUEUE_DEPTH = 8  # Number of direct I/O requests kept in flight at once
+DIRECT_IO_ALIGNMENT = 4096  # Offsets & sizes of direct I/O need to be aligned to this
+PROGRESS_UPDATE_INTERVAL = 1 / 30  # Minimum number of seconds between progress updates
+
+
+def _throttled_progress_updater(progress: Progress, task):
     """
-    Copies the image to the device using dd and shows a progress percentage.
+    Returns a function that sets how much of the task is completed, but only passes
+    it on to the progress bar at most every PROGRESS_UPDATE_INTERVAL seconds. The
+    copies can report progress far more often than it's worth redrawing it.
     """
-    # Get the size of the image file
-    image_size = os.path.getsize(image_path)
+    last_update = 0.0
+
+    def update(completed: int):
+        nonlocal last_update
+        now = time.monotonic()
+        if now - last_update >= PROGRESS_UPDATE_INTERVAL:
+            progress.update(task, completed=completed)
+            last_update = now
+
+    return update
 
-    command = f"dd if={image_path} of={device} bs=4M status=progress"
 
+def _copy_with_queued_writes(
+    image_path: str, device: str, image_size: int, progress: Progress, task
+):
+    """
+    Copies the image to the device with direct I/O, keeping up to IO_QUEUE_DEPTH
+    chunks in flight at once, so that the device always has requests queued instead
+    of waiting for each write to complete before issuing the next one. Each chunk is
+    read and written by a worker thread (the GIL is released while they block).
+    Raises OSError if direct I/O isn't supported for this pair of files.
+    """
+    if image_size % DIRECT_IO_ALIGNMENT != 0:
+        raise OSError(errno.EINVAL, "The image size isn't aligned for direct I/O")
+
+    src_fd = os.open(image_path, os.O_RDONLY | os.O_DIRECT)
+    try:
+        dst_fd = os.open(device, os.O_WRONLY | os.O_DIRECT)
+        try:
+            # One buffer per request in flight, allocated once and reused for every
+            # chunk. Direct I/O needs aligned buffers, which anonymous mmaps are.
+            with mmap.mmap(-1, IO_QUEUE_DEPTH * IO_CHUNK_SIZE) as buffers:
+                free_buffers = queue.SimpleQueue()
+                for idx in range(IO_QUEUE_DEPTH):
+                    start = idx * IO_CHUNK_SIZE
+                    end = start + IO_CHUNK_SIZE
+                    free_buffers.put(memoryview(buffers)[start:end])
+                try:
+                    _run_queued_writes(
+                        src_fd, dst_fd, image_size, free_buffers, progress, task
+                    )
+                finally:
+                    # The mmap can't be closed while there are views of it
+                    while not free_buffers.empty():
+                        free_buffers.get().release()
+            # Direct I/O skips the page cache, but not the device's own write cache
+            os.fdatasync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _run_queued_writes(
+    src_fd: int,
+    dst_fd: int,
+    image_size: int,
+    free_buffers: queue.SimpleQueue,
+    progress: Progress,
+    task,
+):
+    """
+    Copies every chunk of the image from a pool of IO_QUEUE_DEPTH worker threads,
+    each one using a buffer from `free_buffers` while it reads and writes its chunk.
+    """
+
+    def copy_chunk(offset: int) -> int:
+        size = min(IO_CHUNK_SIZE, image_size - offset)
+        buffer = free_buffers.get()
+        try:
+            with buffer[:size] as chunk:
+                if os.preadv(src_fd, [chunk], offset) != size:
+                    raise OSError(errno.EIO, "Short read from the image")
+                if os.pwrite(dst_fd, chunk, offset) != size:
+                    raise OSError(errno.EIO, "Short write to the device")
+        finally:
+            free_buffers.put(buffer)
+        return size
+
+    update_progress = _throttled_progress_updater(progress, task)
+    with ThreadPoolExecutor(max_workers=IO_QUEUE_DEPTH) as executor:
+        try:
+            copied = 0
+            for size in executor.map(copy_chunk, range(0, image_size, IO_CHUNK_SIZE)):
+                copied += size
+                update_progress(copied)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def _copy_in_kernel(
+    image_path: str, device: str, image_size: int, progress: Progress, task
+):
+    """
+    Copies the image to the device without the data ever leaving the kernel, with
+    os.copy_file_range or, when that isn't supported for this pair of files (most
+    kernels won't copy into a block device with it), with os.sendfile.
+    Raises OSError if neither of them is supported.
+    """
+    src_fd = os.open(image_path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(device, os.O_WRONLY)
+        try:
+            update_progress = _throttled_progress_updater(progress, task)
+            offset = 0
+            use_copy_file_range = True
+            while offset < image_size:
+                count = min(KERNEL_COPY_CHUNK_SIZE, image_size - offset)
+                if use_copy_file_range:
+                    try:
+                        copied = os.copy_file_range(
+                            src_fd, dst_fd, count, offset, offset
+                        )
+                    except OSError as e:
+                        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL):
+                            raise
+                        # sendfile writes at the current position of the device
+                        use_copy_file_range = False
+                        os.lseek(dst_fd, offset, os.SEEK_SET)
+                        continue
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, count)
+                if copied == 0:
+                    break
+                offset += copied
+                update_progress(offset)
+            if offset < image_size:
+                raise OSError(errno.EIO, "Short copy to the device")
+            # Make sure everything actually made it to the device
+            os.fdatasync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _copy_with_dd(image_path: str, device: str, progress: Progress, task):
+    """
+    Copies the image to the device using dd, parsing its output for the progress.
+    Exits with dd's error message if it fails.
+    """
+    # dd only runs once direct I/O has been refused for these files, so there's no
+    # point in asking it for direct I/O either.
+    command = [
+        "dd",
+        f"if={image_path}",
+        f"of={device}",
+        "bs=4M",
+        "status=progress",
+        "conv=fsync",
+    ]
+
+    # stderr is read as raw bytes, there's no need to decode anything to get the
+    # number of bytes copied.
     with subprocess.Popen(
-        command, shell=True, stderr=subprocess.PIPE, bufsize=1, text=True
-    ) as proc, Progress(console=console) as progress:
-        task = progress.add_task("Copying image.", total=image_size)
-        for line in proc.stderr:
+        command, stderr=subprocess.PIPE, bufsize=1 << 16, text=False
+    ) as proc:
+        # Read whatever dd has written so far in one go and only look at the most
+        # recent status line, instead of waking up for every single line.
+        update_progress = _throttled_progress_updater(progress, task)
+        pending = b""
+        error = b""
+        while chunk := proc.stderr.read1(4096):
+            # Keep a trailing partial line around until the rest of it arrives
+            output = pending + chunk
+            end = max(output.rfind(b"\r"), output.rfind(b"\n")) + 1
+            output, pending = output[:end], output[end:]
             # Extract the amount of data copied so far
-            if "bytes" in line:
-                parts = line.split()
-                if len(parts) > 0 and parts[0].isdigit():
-                    bytes_copied = int(parts[0])
-                    progress.update(task, completed=bytes_copied)
+            if matches := DD_PROGRESS_RE.findall(output):
+                update_progress(int(matches[-1]))
+            if errors := DD_ERROR_RE.findall(output):
+                error = errors[-1]
+        if errors := DD_ERROR_RE.findall(pending):
+            error = errors[-1]
         proc.wait()
-    refresh_device_state(device, debug)
-
 
-def get_partition_info(device: str, debug: bool = False):
+    if proc.returncode != 0:
+        console.print(
+            f"dd could not copy the image: {error.decode(errors='replace')}",
+            style=error_style,
+        )
+        raise typer.Abort()
 
-    result = run_command(f"parted {device} -ms unit s print", debug)
-    lines = result.stdout.splitlines()
 
-    # Find the start and end sectors of the second partition
-    partition_info = {}
-    total_sectors = None
-    for line in lines:
-        if "BYT" in line:
-            continue
-        if f"{device}" in line:
-            total_sectors = int(line.split(":")[1].replace("s", ""))
-            continue
+def copy_image_with_progress(
+    image_path: str, device: str, image_size: int, debug: bool
+):
+    """
+    Copies the image to the device and shows a progress percentage. Uses direct I/O
+    or an in-kernel copy where possible and falls back to dd otherwise. The size of
+    the image is passed in, since the caller has already stat()ed it.
+    """
+    copy_methods = [
+        ("direct I/O", _copy_with_queued_writes),
+        ("copy_file_range/sendfile", _copy_in_kernel),
+    ]
+    with Progress(console=console) as progress:
+        task = progress.add_task("Copying image.", total=image_size)
+        for name, copy in copy_methods:
+            try:
+                copy(image_path, device, image_size, progress, task)
+                break
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    console.print(f"Could not copy the image: {e}", style=error_style)
+                    raise typer.Abort()
+                console.print(
+                    f"Can't copy the image with {name}: {e.strerror}.",
+                    style=warning_style,
+                )
+                progress.reset(task)
+        else:
+            console.print("Falling back to dd.", style=warning_style)
+            _copy_with_dd(image_path, device, progress, task)
+        # The last updates of the copy may have been skipped by the throttling
+        progress.update(task, completed=image_size)
+    refresh_device_state(device, debug)
 
-        index, start, end, length, filesystem = line.split(":")[:5]
-        partition_info[index] = {
-            "start": int(start.replace("s", "")),
-            "end": int(end.replace("s", "")),
-            "length": int(length.replace("s", "")),
-            "filesystem": filesystem,
-        }
 
-    return total_sectors, partition_info
+def get_partition_info(device: str):
+    """
+    Gets the logical sector size of the device, its total number of sectors and the
+    start, end and length (in sectors) of each of its partitions, keyed by partition
+    number. Cached along with the rest of the device state, see
+    `read_sysfs_partitions`.
+    """
+    return read_sysfs_partitions(device)
 
 
 def align_sector(sector, alignment=2048):
     """
-    Aligns the given sector to the nearest alignment boundary.
+    Aligns the given sector up to the nearest alignment boundary. The alignment needs
+    to be a power of 2.
     """
-    return ((sector + alignment - 1) // alignment) * alignment
+    return (sector + alignment - 1) & ~(alignment - 1)
 
 
 @app.command()
 def manage_partitions(
     device: str,
-    system_size: str = typer.Option(
-        None, help="Size for the system partition (e.g., 128G)."
+    system_size: int = typer.Option(
+        None, help="Size for the system partition in GB (e.g., 128)."
     ),
     image_path: str = typer.Option(None, help="The path of the image."),
     force: bool = typer.Option(
@@ -136,7 +338,7 @@ def manage_partitions(
     """
     refresh_device_state(device, debug)
 
-    disk_capacity_gb = get_disk_capacity(device, debug)
+    disk_capacity_gb = get_disk_capacity(device)
     suggested_system_capacity = int(max(disk_capacity_gb / 3, 100))
 
     console.print(f"Using device: {device} ({disk_capacity_gb}GB)", style=success_style)
@@ -149,23 +351,26 @@ def manage_partitions(
     if image_path is None:
         image_path = Prompt.ask("Enter the image path")
 
-    # Check if the image path exists and is a `.img` image
+    # Check if the image path exists and is a `.img` image, with a single stat() call
     path = Path(image_path)
-    if path.exists() and path.is_file():
-        if not path.suffix == ".img":
-            if not Confirm.ask(
-                rich.text.Text(
-                    f"File {str(path)} does not appear to be an .img file. Are you sure?",
-                    style=warning_style,
-                )
-            ):
-                raise typer.Abort()
-    else:
+    try:
+        image_stat = os.stat(path)
+    except OSError:
+        image_stat = None
+    if image_stat is None or not stat.S_ISREG(image_stat.st_mode):
         console.print(
             f"Path {str(path)} does not exist. Please enter a valid .img file path.",
             style=error_style,
         )
         raise typer.Abort()
+    if not path.suffix == ".img":
+        if not Confirm.ask(
+            rich.text.Text(
+                f"File {str(path)} does not appear to be an .img file. Are you sure?",
+                style=warning_style,
+            )
+        ):
+            raise typer.Abort()
 
     # Check if the system partition size is within recommended limits
     if system_size < MIN_SYSTEM_SIZE:
@@ -193,7 +398,7 @@ def manage_partitions(
             raise typer.Abort()
 
     # Check if the device is empty, unless force flag is set
-    if not check_device_empty(device, debug):
+    if not device_is_empty(device):
         if force:
             erase_device(device, debug)
         else:
@@ -204,19 +409,19 @@ def manage_partitions(
             raise typer.Abort()
 
     # Copy the image to the device with a progress bar
-    copy_image_with_progress(image_path, device, debug)
+    copy_image_with_progress(image_path, device, image_stat.st_size, debug)
 
-    # Wait for the device to be recognized
+    # Wait for the device to be recognized. The kernel has already read the new
+    # partition table, only the device node may still be missing.
     console.print("Waiting for the device to be recognized.", style=success_style)
-    run_command("sleep 5", debug)
+    # boot_partition = partition_path(device, 1)
+    system_partition = partition_path(device, 2)
+    wait_for_device(system_partition, debug)
 
     # Check the partition table type
-    result = run_command(f"fdisk -l {device}", debug)
+    result = run_command(["fdisk", "-l", device], debug, capture_stdout=True)
     if "Disklabel type: dos" in result.stdout:
         console.print("Detected DOS partition table.", style=success_style)
-        # boot_partition = f"{device}1"
-        system_partition = f"{device}2"
-        additional_partition = f"{device}3"
     else:
         console.print(
             "Partition table is not DOS. Will not continue.", style=error_style
@@ -226,55 +431,82 @@ def manage_partitions(
     # Verify that the copied partition is valid and fix it if necessary
     console.print("Checking and resizing the system partition.", style=success_style)
 
-    run_command(f"e2fsck -f -y {system_partition} || true", debug)
+    # e2fsck exits non-zero when it fixes something, which is fine here.
+    run_command(["e2fsck", "-f", "-y", system_partition], debug, check=False)
 
-    total_sectors, partition_info = get_partition_info(device, debug)
+    sector_size, total_sectors, partition_info = get_partition_info(device)
     if not partition_info.get("2"):
         console.print("Could not get 2nd partition info.", style=error_style)
         raise typer.Abort()
 
+    # parted's sectors are the device's logical sectors, which aren't always 512B
+    # Convert GB to sectors (1GB = 2^30 bytes)
+    system_size_sectors = (system_size << 30) // sector_size
+    # Partitions are aligned to 1MiB, whatever the sector size
+    alignment = PARTITION_ALIGNMENT // sector_size
     # Align the end sector for the system partition
-    system_size_sectors = system_size * 1024 * 1024 * 1024 // 512
-    # Convert GB to sectors
     system_partition_new_end = align_sector(
-        partition_info["2"]["start"] + system_size_sectors
+        partition_info["2"]["start"] + system_size_sectors, alignment
     )
 
-    # Resize the partition
-    run_command(
-        f"parted {device} --script resizepart 2 {system_partition_new_end}s", debug
-    )
-    console.print("Checking filesystem on resized partition.", style=success_style)
-
-    run_command(f"e2fsck -f -y {system_partition} || true", debug)
+    # Calculate the end sector for the additional partition
+    # Use all remaining sectors, aligned down to the alignment boundary
+    additional_partition_end = (total_sectors - 1) & ~(alignment - 1)
+    additional_partition_start = align_sector(system_partition_new_end + 1, alignment)
 
-    # Create the additional partition using the end sector of the second partition
+    # Resize the system partition and create the additional partition in the
+    # remaining space with a single parted run, so that the partition table is
+    # only written and re-read once.
     console.print(
-        "Creating additional partition in the remaining space.", style=success_style
+        "Resizing the system partition and creating additional partition in the "
+        "remaining space.",
+        style=success_style,
     )
-
-    # Calculate the end sector for the additional partition
-    additional_partition_end = total_sectors - 1  # Use all remaining sectors
-    if additional_partition_end % 2048 != 0:
-        additional_partition_end -= additional_partition_end % 2048
-    additional_partition_start = align_sector(system_partition_new_end + 1)
-
     run_command(
-        f"parted {device} --script mkpart primary {additional_partition_start}s {additional_partition_end}s",
+        [
+            "parted",
+            device,
+            "--script",
+            "resizepart",
+            "2",
+            f"{system_partition_new_end}s",
+            "mkpart",
+            "primary",
+            f"{additional_partition_start}s",
+            f"{additional_partition_end}s",
+        ],
         debug,
     )
-    refresh_device_state(device, debug)
+    # parted tells the kernel about the new partitions itself when it's done, so
+    # there's no need to run partprobe again.
+    clear_device_state_caches()
 
     # Wait for the device to be recognized
     console.print("Waiting for the device to be recognized.", style=success_style)
-    run_command("sleep 5", debug)
+    additional_partition = partition_path(device, 3)
+    wait_for_device(additional_partition, debug)
 
-    # Format the new partition
+    # Format the new partition. The inode tables and the journal are initialized
+    # lazily by the kernel once it's mounted, and nothing is reserved for root since
+    # it's only used for data.
     console.print("Formatting the new partition.", style=success_style)
-    run_command(f"mkfs.ext4 {additional_partition}", debug)
+    run_command(
+        [
+            "mkfs.ext4",
+            "-F",
+            "-E",
+            "lazy_itable_init=1,lazy_journal_init=1",
+            "-m",
+            "0",
+            additional_partition,
+        ],
+        debug,
+    )
 
-    console.print("Checking filesystem on additional partition.", style=success_style)
-    run_command(f"e2fsck -f -y {additional_partition} || true", debug)
+    # The new filesystem was just created, only the resized one needs a check.
+    console.print("Checking filesystem on resized partition.", style=success_style)
+    # e2fsck exits non-zero when it fixes something, which is fine here.
+    run_command(["e2fsck", "-f", "-y", system_partition], debug, check=False)
 
     console.print("Disk management complete.", style=success_style)
 
@@ -1,4 +1,9 @@
+import fcntl
+import functools
+import os
+import shlex
 import subprocess
+from pathlib import Path
 
 import rich
 import typer
@@ -6,6 +11,18 @@ import typer
 # TODO: use https://rich.readthedocs.io/en/stable/logging.html#logging-handler
 console = rich.console.Console()
 
+# Caches of functions decorated with `cache_device_state`
+_device_state_caches = []
+
+# sysfs always reports sizes in 512 byte sectors, whatever the device's sector size
+SYSFS_SECTOR_SIZE = 512
+
+# Longer command outputs are truncated before being printed
+MAX_PANEL_OUTPUT_SIZE = 16 * 1024
+
+# ioctl that makes the kernel re-read the partition table of a block device
+BLKRRPART = 0x125F
+
 
 def get_panel(text: str, title: str, border_style: str):
     return rich.panel.Panel(
@@ -18,49 +35,218 @@ def get_panel(text: str, title: str, border_style: str):
     )
 
 
-def run_command(command: str, debug: bool = False):
+def _truncate_output(output: str) -> str:
     """
-    Runs a shell command and prints the command in gray. If the command succeeds,
-    prints a success message in green; if it fails, prints the error in red and exits.
+    Keeps only the beginning and the end of long command outputs, since rendering
+    them in a panel gets slow.
+    """
+    if len(output) <= MAX_PANEL_OUTPUT_SIZE:
+        return output
+    half = MAX_PANEL_OUTPUT_SIZE // 2
+    return f"{output[:half]}\n...\n{output[-half:]}"
+
+
+def run_command(
+    command: list[str],
+    debug: bool = False,
+    capture_stdout: bool = False,
+    check: bool = True,
+):
+    """
+    Runs a command (given as an argv list) and prints it in gray. If the command
+    fails, prints the error in red and exits, unless check is False.
     If debug is True, prints the output of the command.
+
+    The command is run directly (no shell involved) and stdout is only captured when
+    capture_stdout (or debug) is True. stderr is always captured so that failures can
+    be reported.
     """
-    console.print(f"Running: {command}", style="bold")
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    console.print(f"Running: {shlex.join(command)}", style="bold")
+    result = subprocess.run(
+        command,
+        stdout=subprocess.PIPE if capture_stdout or debug else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    _report_result(result, debug, check)
+    return result
 
-    if debug or result.returncode != 0:
-        if result.stdout:
-            console.print(
-                get_panel(
-                    text=result.stdout,
-                    title=rich.text.Text("stdout", style="green bold"),
-                    border_style="green",
-                )
+
+def _report_result(
+    result: subprocess.CompletedProcess, debug: bool = False, check: bool = True
+):
+    """
+    Prints the output of the command if debug is True or if it failed, and exits if
+    it failed (unless check is False).
+    """
+    failed = check and result.returncode != 0
+    if not debug and not failed:
+        return
+
+    if result.stdout:
+        console.print(
+            get_panel(
+                text=_truncate_output(result.stdout),
+                title=rich.text.Text("stdout", style="green bold"),
+                border_style="green",
             )
-        if result.stderr:
-            console.print(
-                get_panel(
-                    text=result.stderr,
-                    title=rich.text.Text("stderr", style="red bold"),
-                    border_style="red",
-                )
+        )
+    if result.stderr:
+        console.print(
+            get_panel(
+                text=_truncate_output(result.stderr),
+                title=rich.text.Text("stderr", style="red bold"),
+                border_style="red",
             )
+        )
 
-        if not result.stdout and not result.stderr:
-            title = (
-                "[green]Command succeeded[/green]"
-                if result.returncode == 0
-                else "[red]Command failed[/red]"
-            )
-            console.print(title)
-    if result.returncode != 0:
+    if not result.stdout and not result.stderr:
+        title = (
+            "[green]Command succeeded[/green]"
+            if result.returncode == 0
+            else "[red]Command failed[/red]"
+        )
+        console.print(title)
+    if failed:
         raise typer.Abort()
 
-    return result
+
+def cache_device_state(func):
+    """
+    Caches the results of a function that queries the state of a device (e.g. through
+    sysfs or lsblk). All the caches are cleared by `refresh_device_state`, which is
+    called after anything modifies a device (or `clear_device_state_caches`).
+    """
+    cached_func = functools.lru_cache(maxsize=None)(func)
+    _device_state_caches.append(cached_func)
+    return cached_func
+
+
+def clear_device_state_caches():
+    """
+    Clears the caches of every function decorated with `cache_device_state`.
+    """
+    for cached_func in _device_state_caches:
+        cached_func.cache_clear()
 
 
 def refresh_device_state(device: str, debug: bool = False):
+    """
+    Makes the kernel re-read the partition table of the device with the BLKRRPART
+    ioctl (what partprobe does, without running it) and waits for udev to catch up.
+    Falls back to partprobe if the kernel refuses, e.g. with EBUSY while one of the
+    partitions is mounted.
+    """
+    clear_device_state_caches()
     console.print("[green]Refreshing the state of the device...[/green]")
-    run_command(f"partprobe {device}", debug)
+    try:
+        fd = os.open(device, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, BLKRRPART)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        if debug:
+            console.print(
+                f"Could not re-read the partition table of {device}: {e.strerror}.",
+                style=warning_style,
+            )
+        run_command(["partprobe", device], debug)
+    else:
+        # Best effort only, callers wait for the nodes they need with wait_for_device
+        run_command(["udevadm", "settle", "--timeout=5"], debug, check=False)
+
+
+@cache_device_state
+def read_sysfs_partitions(
+    device: str,
+) -> tuple[int, int, dict[str, dict[str, int | str]]]:
+    """
+    Reads the size of the device and the geometry of its partitions from sysfs, so
+    that nothing needs to be run. Returns the logical sector size of the device (what
+    parted's `s` unit means), the total number of logical sectors and the start, end
+    and length (in logical sectors) and the kernel's name (e.g. `nvme0n1p2`) of each
+    partition, keyed by partition number (e.g. "2").
+
+    The result is cached until the device state is refreshed, so the disk capacity
+    and the partition geometry are only read once between changes to the device.
+    """
+    name = os.path.basename(os.path.realpath(device))
+    block_path = Path("/sys/block") / name
+    try:
+        sector_size = int((block_path / "queue" / "logical_block_size").read_text())
+        # sysfs counts in 512 byte sectors, convert to the device's own sectors
+        scale = sector_size // SYSFS_SECTOR_SIZE
+        total_sectors = int((block_path / "size").read_text()) // scale
+        partitions = {}
+        # Partitions show up as subdirectories named after the disk, e.g. `sda2`
+        for partition_dir in block_path.glob(f"{name}*"):
+            # Not everything named like that is a partition (e.g. `mmcblk0boot0`)
+            if not (partition_dir / "partition").exists():
+                continue
+            start = int((partition_dir / "start").read_text()) // scale
+            length = int((partition_dir / "size").read_text()) // scale
+            index = (partition_dir / "partition").read_text().strip()
+            partitions[index] = {
+                "start": start,
+                "end": start + length - 1,
+                "length": length,
+                "name": partition_dir.name,
+            }
+    except FileNotFoundError:
+        console.print(
+            f"Could not find {device} in /sys/block. Is it a whole disk?",
+            style=error_style,
+        )
+        raise typer.Abort()
+    return sector_size, total_sectors, partitions
+
+
+def partition_path(device: str, number: int) -> str:
+    """
+    Gets the path of the device node of the given partition of a disk, e.g.
+    `/dev/sda2` or `/dev/nvme0n1p2`, from the partition's name in sysfs. Exits if the
+    kernel doesn't know about the partition.
+    """
+    _, _, partitions = read_sysfs_partitions(device)
+    try:
+        return f"/dev/{partitions[str(number)]['name']}"
+    except KeyError:
+        console.print(
+            f"Could not find partition {number} of {device} in /sys/block.",
+            style=error_style,
+        )
+        raise typer.Abort()
+
+
+def device_is_empty(device: str) -> bool:
+    """
+    Checks if the given device is empty, i.e. it has no partitions, according to
+    sysfs.
+    """
+    _, _, partitions = read_sysfs_partitions(device)
+    return not partitions
+
+
+def wait_for_device(device: str, debug: bool = False, timeout: int = 30):
+    """
+    Waits until udev has created the given device node, returning as soon as it
+    exists. Exits if it still doesn't exist afterwards: udevadm also returns once the
+    udev queue is empty (or right away without a udev daemon, e.g. in Docker), even
+    if the node never appeared.
+    """
+    run_command(
+        [
+            "udevadm",
+            "settle",
+            f"--timeout={timeout}",
+            f"--exit-if-exists={device}",
+        ],
+        debug,
+    )
+    if not os.path.exists(device):
+        console.print(f"The device {device} did not show up.", style=error_style)
+        raise typer.Abort()
 
 
 warning_style = rich.style.Style(color="yellow", bold=True)